@@ -1,54 +1,216 @@
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
+from flask import Flask, Response, request
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import logging
 import os
+import time
 
 # Load environment variables from .env file
 load_dotenv()
 
-from langchain_ibm import WatsonxLLM
+# Per-message logs are DEBUG so they cost nothing at the default INFO level.
+# An unknown LOG_LEVEL falls back to INFO instead of stopping the app
+log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+if not isinstance(log_level, int):
+    log_level = logging.INFO
+logging.basicConfig(level=log_level)
+logger = logging.getLogger(__name__)
+
+from ibm_watsonx_ai import APIClient, Credentials
+from ibm_watsonx_ai.utils import HttpClientConfig
+from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
+from llm_cache import ResponseCache, SemanticCache
+import httpx
+
+# Worker threads that may call Watsonx at once: replies and similarity
+# lookups on llm_executor, streamed replies on stream_executor
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "32"))
+STREAM_MAX_WORKERS = int(os.getenv("STREAM_MAX_WORKERS", "32"))
+
+# One authenticated Watsonx client shared by the LLM and the embedder, with a
+# keep-alive connection pool so requests reuse open TLS connections. The pool
+# has a connection for every worker, and the timeouts are finite so a stuck
+# call eventually frees its worker instead of holding it for the SDK's 30min
+watsonx_client = APIClient(
+    credentials=Credentials(
+        url=os.getenv("WATSONX_URL"),
+        api_key=os.getenv("WATSONX_APIKEY")
+    ),
+    project_id=os.getenv("WATSONX_PROJECT_ID"),
+    httpx_client=HttpClientConfig(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_WORKERS + STREAM_MAX_WORKERS,
+            max_keepalive_connections=LLM_MAX_WORKERS + STREAM_MAX_WORKERS,
+            keepalive_expiry=60
+        ),
+        timeout=httpx.Timeout(float(os.getenv("WATSONX_HTTP_TIMEOUT", "30")), connect=5)
+    )
+)
 
 # Initialize Granite 13B Instruct model (✅ supported in Watsonx)
 llm = WatsonxLLM(
     model_id="ibm/granite-13b-instruct-v2",
-    url=os.getenv("WATSONX_URL"),
-    apikey=os.getenv("WATSONX_APIKEY"),
-    project_id=os.getenv("WATSONX_PROJECT_ID")
+    project_id=os.getenv("WATSONX_PROJECT_ID"),
+    watsonx_client=watsonx_client
+)
+
+# Embedding model used to match paraphrased questions to earlier replies
+embeddings = WatsonxEmbeddings(
+    model_id="ibm/slate-30m-english-rtrvr",
+    project_id=os.getenv("WATSONX_PROJECT_ID"),
+    watsonx_client=watsonx_client
+)
+
+# Response caches shared by all requests: exact prompt matches first, then
+# semantically similar questions, both kept for 1h. Set RESPONSE_CACHE_PATH
+# to keep exact matches on disk across restarts and worker processes
+response_cache = ResponseCache(ttl=3600, path=os.getenv("RESPONSE_CACHE_PATH"))
+semantic_cache = SemanticCache(embeddings, threshold=0.85, ttl=3600)
+
+# Prompt sent to Granite for financial guidance. The instructions form a
+# fixed prefix and the user's message always comes last, so every prompt
+# shares byte-identical leading tokens that Watsonx can reuse
+PROMPT_PREFIX = (
+    "You are a smart personal finance assistant. "
+    "Respond with clear, concise, and practical financial advice.\n"
+)
+PROMPT_TEMPLATE = PROMPT_PREFIX + "User message: '{message}'"
+
+# Thread pool for blocking Watsonx calls, so a request can stop waiting on
+# a call that runs past its deadline
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS)
+
+# Give up on a reply before Twilio's 15s webhook timeout. The similarity
+# lookup and the Granite call share this budget, and the lookup counts as a
+# miss if it takes longer than EMBED_TIMEOUT
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "12"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "2"))
+
+# Optionally stream long Granite replies as several WhatsApp messages sent
+# through the Twilio REST API, instead of one TwiML reply at the end
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "").lower() in ("1", "true", "yes")
+STREAM_CHUNK_CHARS = 160
+twilio_client = None
+stream_executor = None
+if STREAM_REPLIES:
+    # Imported here so the Twilio REST SDK only loads when streaming is on
+    from twilio.rest import Client
+    twilio_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+
+    # Streams hold a worker for the whole generation, so they get their own
+    # pool and can never starve the lookups and replies on llm_executor
+    stream_executor = ThreadPoolExecutor(max_workers=STREAM_MAX_WORKERS)
+
+# TwiML reply envelope, filled in with the escaped message text
+TWIML_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    "<Response><Message><Body>{body}</Body></Message></Response>"
 )
 
 # Initialize Flask app
 app = Flask(__name__)
 
+def take_stream_chunk(buffer):
+    # Send whole paragraphs, or whole sentences once the buffer is long enough.
+    # Leading breaks are dropped first so a separator at index 0 can't hide
+    # the sentence fallback
+    buffer = buffer.lstrip()
+    cut = buffer.rfind("\n\n")
+    if cut == -1 and len(buffer) > STREAM_CHUNK_CHARS:
+        cut = max(buffer.rfind(". "), buffer.rfind("\n"))
+    if cut <= 0:
+        return None, buffer
+    return buffer[:cut + 1].strip(), buffer[cut + 1:].lstrip()
+
+def stream_reply(incoming_msg, prompt, query_vector, sender, bot_number):
+    tokens = []
+    buffer = ""
+    try:
+        for token in llm.stream(prompt):
+            tokens.append(token)
+            buffer += token
+            chunk, buffer = take_stream_chunk(buffer)
+            if chunk:
+                twilio_client.messages.create(from_=bot_number, to=sender, body=chunk)
+        if buffer.strip():
+            twilio_client.messages.create(from_=bot_number, to=sender, body=buffer.strip())
+    except Exception:
+        logger.exception("❌ Streaming Error")
+        try:
+            twilio_client.messages.create(
+                from_=bot_number,
+                to=sender,
+                body="⚠️ Sorry, I couldn’t process that message at the moment."
+            )
+        except Exception:
+            logger.exception("❌ Could not send the streaming apology to %s", sender)
+        return
+
+    # Cache the reply exactly as Granite produced it, like the TwiML path does
+    response = "".join(tokens)
+    logger.debug("🤖 Response streamed: %s", response)
+    response_cache.set(prompt, response)
+    if query_vector is not None:
+        semantic_cache.set(incoming_msg, response, vector=query_vector)
+
+def generate_reply(incoming_msg, prompt, sender, bot_number):
+    deadline = time.monotonic() + LLM_TIMEOUT
+
+    # Reuse the reply to a similar earlier question if we have one
+    hit, query_vector = None, None
+    lookup = llm_executor.submit(semantic_cache.get, incoming_msg)
+    try:
+        hit, similarity, query_vector = lookup.result(timeout=EMBED_TIMEOUT)
+    except Exception as e:
+        lookup.cancel()
+        logger.warning("⚠️ Cache lookup failed: %r", e)
+
+    if hit is not None:
+        logger.debug("⚡ Cache hit (%.2f): %s", similarity, hit)
+        return hit
+
+    # Stream the reply in the background and acknowledge the webhook right away
+    if STREAM_REPLIES:
+        stream_executor.submit(stream_reply, incoming_msg, prompt, query_vector, sender, bot_number)
+        return "⏳ Working on it…"
+
+    # Generate reply using Granite LLM, one request per message so a short
+    # reply never waits on someone else's long one
+    future = llm_executor.submit(llm.invoke, prompt)
+    try:
+        response = future.result(timeout=deadline - time.monotonic())
+        logger.debug("🤖 Response sent: %s", response)
+    except Exception:
+        future.cancel()
+        logger.exception("❌ LLM Error")
+        return "⚠️ Sorry, I couldn’t process that message at the moment."
+
+    response_cache.set(prompt, response)
+    if query_vector is not None:
+        semantic_cache.set(incoming_msg, response, vector=query_vector)
+    return response
+
 @app.route("/whatsapp", methods=['POST'])
 def whatsapp_reply():
     # Receive WhatsApp message details from Twilio
     incoming_msg = request.form.get("Body")
     sender = request.form.get("From")
 
-    # Debug log for your terminal
-    print(f"📥 New WhatsApp message from {sender}: {incoming_msg}")
+    # Debug log for your terminal (set LOG_LEVEL=DEBUG to see it)
+    logger.debug("📥 New WhatsApp message from %s: %s", sender, incoming_msg)
 
-    # Prompt sent to Granite for financial guidance
-    prompt = (
-        f"You are a smart personal finance assistant. "
-        f"A user just said: '{incoming_msg}'. "
-        f"Respond with clear, concise, and practical financial advice."
-    )
+    prompt = PROMPT_TEMPLATE.format(message=incoming_msg)
 
-    # Generate reply using Granite LLM
-    try:
-        response = llm.invoke(prompt)
-        print(f"🤖 Response sent: {response}")
-    except Exception as e:
-        print(f"❌ LLM Error: {e}")
-        response = "⚠️ Sorry, I couldn’t process that message at the moment."
+    # Identical prompts are answered straight from the cache
+    response = response_cache.get(prompt)
+    if response is not None:
+        logger.debug("⚡ Cache hit: %s", response)
+    else:
+        response = generate_reply(incoming_msg, prompt, sender, request.form.get("To"))
 
     # Send response back to the user via Twilio
-    twilio_response = MessagingResponse()
-    msg = twilio_response.message()
-    msg.body(response)
-
-    return str(twilio_response)
+    return Response(TWIML_TEMPLATE.format(body=escape(response)), mimetype="application/xml")
 
 # Run the Flask app
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+import atexit
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_key(prompt):
+    return "resp:" + hashlib.md5(prompt.encode()).hexdigest()
+
+
+# Exact-match cache: identical prompts get the stored reply until it expires.
+# With a path, replies are also kept zstd-compressed in SQLite so they
+# survive restarts and are shared by every worker process
+class ResponseCache:
+    def __init__(self, ttl=3600, max_entries=5000, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._db = None
+        # Guards the reader connection, so disk reads never hold self._lock
+        self._db_lock = threading.Lock()
+        self._writes = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value BLOB, expires_at REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+            self._decompressor = zstandard.ZstdDecompressor()
+
+            # Writes go through a background thread with its own connection,
+            # so set() never waits on a SQLite commit. Whatever is still
+            # queued at exit is flushed before the process ends
+            self._writes = queue.Queue()
+            self._writer = threading.Thread(
+                target=self._write_loop, args=(path,), name="response-cache-writer", daemon=True
+            )
+            self._writer.start()
+            atexit.register(self.close)
+
+    def get(self, prompt):
+        key = prompt_key(prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None and self._db is not None:
+            # A broken disk tier only costs a cache miss, never the request
+            try:
+                entry = self._load(key)
+            except (sqlite3.Error, zstandard.ZstdError, UnicodeDecodeError) as e:
+                logger.warning("⚠️ Disk cache read failed: %s", e)
+                return None
+            if entry is not None:
+                with self._lock:
+                    # A set() that landed during the read is newer, keep it
+                    if key not in self._entries:
+                        self._remember(key, *entry)
+
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.time():
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return None
+        return response
+
+    def set(self, prompt, response):
+        key = prompt_key(prompt)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, response)
+        if self._writes is not None:
+            self._writes.put((key, expires_at, response))
+
+    def close(self, timeout=5):
+        # Ask the writer to flush what is queued and stop
+        if self._writes is not None and self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join(timeout)
+
+    def _write_loop(self, path):
+        db = None
+        compressor = zstandard.ZstdCompressor()
+        while True:
+            # Commit everything queued so far in one transaction. None is the
+            # stop signal from close()
+            pending = [self._writes.get()]
+            while True:
+                try:
+                    pending.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in pending
+            pending = [item for item in pending if item is not None]
+
+            # Failures are logged and dropped so the writer keeps running: a
+            # reply that can't be compressed skips only itself, a SQLite error
+            # the batch
+            rows = []
+            for key, expires_at, response in pending:
+                try:
+                    rows.append((key, compressor.compress(response.encode()), expires_at))
+                except Exception:
+                    logger.exception("❌ Could not compress a cached reply")
+
+            # The connection context commits, or rolls back if a statement fails
+            try:
+                if db is None:
+                    db = sqlite3.connect(path)
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", rows)
+                    # Expired rows are never read again, so clear them out as we go
+                    db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            except Exception:
+                logger.exception("❌ Disk cache write failed")
+
+            if stop:
+                if db is not None:
+                    db.close()
+                return
+
+    def _load(self, key):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at >= ?",
+                (key, time.time())
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            response = self._decompressor.decompress(value).decode()
+        return expires_at, response
+
+    def _remember(self, key, expires_at, response):
+        self._entries.pop(key, None)
+        self._entries[key] = (expires_at, response)
+
+        # Dicts keep insertion order, so the first keys are the oldest
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+
+# Semantic cache: paraphrased questions ("how do I budget?" / "help me budget")
+# resolve to the same stored Granite reply when their embeddings are close
+# enough, until the stored reply expires
+class SemanticCache:
+    def __init__(self, embedder, threshold=0.85, max_entries=1000, ttl=3600):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Vectors live in one float32 matrix allocated on first insert and
+        # reused as a ring buffer, so inserts never copy the whole cache
+        self._vectors = None
+        self._responses = [None] * max_entries
+        self._expires_at = np.zeros(max_entries)
+        self._count = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, text):
+        vector = np.asarray(self.embedder.embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+    def get(self, text):
+        # Returns (response or None, best similarity, query vector) so a miss
+        # can be stored with set() without embedding the message twice
+        vector = self._embed(text)
+        with self._lock:
+            if not self._count:
+                return None, 0.0, vector
+            similarities = self._vectors[:self._count] @ vector
+            # Expired slots can never match
+            similarities[self._expires_at[:self._count] < time.time()] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity >= self.threshold:
+                return self._responses[best], similarity, vector
+        return None, similarity, vector
+
+    def set(self, text, response, vector=None):
+        if vector is None:
+            vector = self._embed(text)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.empty((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+            # Overwrite the oldest slot once the cache is full
+            self._vectors[self._next] = vector
+            self._responses[self._next] = response
+            self._expires_at[self._next] = time.time() + self.ttl
+            self._next = (self._next + 1) % self.max_entries
+            self._count = min(self._count + 1, self.max_entries)